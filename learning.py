@@ -266,11 +266,11 @@ class CountingProbDist:
         for o in observations:
             self.add(o)
 
-    def add(self, o):
-        """Add an observation o to the distribution."""
+    def add(self, o, count=1):
+        """Add an observation o to the distribution, count times."""
         self.smooth_for(o)
-        self.dictionary[o] += 1
-        self.n_obs += 1
+        self.dictionary[o] += count
+        self.n_obs += count
         self.sampler = None
 
     def smooth_for(self, o):
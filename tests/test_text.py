@@ -4,6 +4,7 @@ import random
 
 from text import *
 from utils import isclose, open_data
+from math import log
 
 
 
@@ -149,6 +150,16 @@ def test_viterbi_segmentation():
         'it', 'is', 'easy', 'to', 'read', 'words', 'without', 'spaces']
 
 
+def test_build_trie():
+    P = UnigramWordModel(words('to top to a'))
+    trie = P.build_trie()
+    assert trie == {'t': {'o': {None: 2, 'p': {None: 1}}}, 'a': {None: 1}}
+    assert P.build_trie() is trie
+
+    P.add('tip')
+    assert P.build_trie()['t']['i'] == {'p': {None: 1}}
+
+
 def test_shift_encoding():
     code = shift_encode("This is a secret message.", 17)
 
@@ -163,6 +174,20 @@ def test_shift_decoding():
     assert msg == 'This is a secret message.'
 
 
+def test_shift_decoder_offline():
+    training_text = 'the cat sat on the mat ' * 50 + '9q 8q 7q 6q 5q ' * 100
+    ring = ShiftDecoder(training_text)
+
+    assert ring.decode(shift_encode('I, Ted', 5)) == 'S, Don'
+    assert ring.decode(shift_encode('the cat', 3)) == 'the cat'
+
+    # digit pairs keep their own counts; other chars are unseen
+    assert isclose(ring.score('9q'), log(ring.P2['9q']))
+    assert isclose(ring.score('8q 7'), log(ring.P2['8q'] * ring.P2['q '] * ring.P2[' 7']))
+    assert isclose(ring.score('T!'), log(ring.P2.default / ring.P2.n_obs))
+    assert ring.score('') == 0
+
+
 def test_permutation_decoder():
     gutenberg = open_data("gutenberg.txt").read()
     flatland = open_data("EN-text/flatland.txt").read()
@@ -174,6 +199,12 @@ def test_permutation_decoder():
     assert pd.decode('aba') in ('ded', 'did', 'ece', 'ele', 'eme', 'ere', 'eve', 'eye', 'iti', 'mom', 'ses', 'tat', 'tit')
 
 
+def test_permutation_decoder_digits():
+    pd = PermutationDecoder(canonicalize('room 101 in 1984 ' * 5 + 'the cat sat'))
+    for c in '0149e ':
+        assert isclose(pd.log_P1[char_indices(c)[0]], log(pd.P1[c] + 1e-5))
+
+
 def test_rot13_encoding():
     code = rot13('Hello, world!')
 
@@ -198,6 +229,12 @@ def test_counting_probability_distribution():
 
     assert 1 / 7 <= min(ps) <= max(ps) <= 1 / 5
 
+    D = CountingProbDist()
+    D.add('a', 3)
+    D.add('b')
+    assert D.dictionary == {'a': 3, 'b': 1}
+    assert D.n_obs == 4
+
 
 def test_ir_system():
     from collections import namedtuple
@@ -271,6 +308,34 @@ def test_ir_system():
     ])
 
 
+def test_ir_system_offline():
+    ir = IRSystem()
+    for text in ['zero\ncat dog', 'one\ncat cat', 'two\ndog', 'three\ncat dog']:
+        ir.index_document(text, text.split()[0])
+    ir.finalize()
+
+    docids = ir.postings['cat'][0]
+    assert list(docids) == [0, 1, 3]
+    # document 1 has no 'dog' and only document 0 has 'zero'
+    for words in (['cat', 'dog'], ['zero'], ['dog', 'unicorn']):
+        scores = ir.total_scores(words, docids)
+        for score, docid in zip(scores, docids):
+            assert isclose(score, ir.total_score(words, docid))
+    assert list(ir.total_scores(['zero'], docids)) == [log(2) / log(4), 0, 0]
+
+    def verify_query(query, expected):
+        assert [docid for _, docid in query] == [docid for _, docid in expected]
+        assert all(isclose(score, e) for (score, _), (e, _) in zip(query, expected))
+
+    # documents 0 and 3 tie; the larger docid comes first, as with nlargest
+    verify_query(ir.query('cat dog'), [(1.0, 3), (1.0, 0), (log(3) / log(4), 1)])
+    verify_query(ir.query('cat dog', 1), [(1.0, 3)])
+    verify_query(ir.query('cat dog', 2), [(1.0, 3), (1.0, 0)])
+    verify_query(ir.query('dog', 100), [(log(2) / log(3), 2), (0.5, 3), (0.5, 0)])
+    assert ir.query('cat dog', 0) == []
+    assert ir.query('cat unicorn') == []
+
+
 def test_words():
     assert words("``EGAD!'' Edgar cried.") == ['egad', 'edgar', 'cried']
 
@@ -286,6 +351,11 @@ def test_translate():
     assert translate(text, func) == 'oranges  apples  lemons  '
 
 
+def test_char_indices():
+    assert list(char_indices('ab z!09')) == [0, 1, 26, 25, 37, 27, 36]
+    assert list(char_indices('AÜ')) == [37, 37]
+
+
 def test_bigrams():
     assert bigrams('this') == ['th', 'hi', 'is']
     assert bigrams(['this', 'is', 'a', 'test']) == [['this', 'is'], ['is', 'a'], ['a', 'test']]
@@ -8,11 +8,11 @@ from utils import argmin, argmax, hashabledict
 from learning import CountingProbDist
 import search
 
-from math import log, exp
-from collections import defaultdict
-import heapq
+from math import log, exp, inf
+from collections import Counter
 import re
 import os
+import numpy as np
 
 
 class UnigramWordModel(CountingProbDist):
@@ -24,8 +24,28 @@ class UnigramWordModel(CountingProbDist):
     def __init__(self, observations, default=0):
         # Call CountingProbDist constructor,
         # passing the observations and default parameters.
+        self.trie = None
         super(UnigramWordModel, self).__init__(observations, default)
 
+    def add(self, o, count=1):
+        """Add an observation o count times, discarding any trie built so far."""
+        super(UnigramWordModel, self).add(o, count)
+        self.trie = None
+
+    def build_trie(self):
+        """Return the observed words as a trie of nested dicts keyed by
+        character; the None key of a node holds the count of the word
+        ending there. The trie is kept until the next call to add."""
+        if self.trie is None:
+            self.trie = {}
+            for word, count in self.dictionary.items():
+                if count:
+                    node = self.trie
+                    for char in word:
+                        node = node.setdefault(char, {})
+                    node[None] = count
+        return self.trie
+
     def samples(self, n):
         """Return a string of n words, random according to the model."""
         return ' '.join(self.sample() for i in range(n))
@@ -42,7 +62,7 @@ class NgramWordModel(CountingProbDist):
         # mapping from (w1, ..., wn-1) to P(wn | w1, ... wn-1)
         CountingProbDist.__init__(self, default=default)
         self.n = n
-        self.cond_prob = defaultdict()
+        self.cond_prob = {}
         self.add_sequence(observation_sequence or [])
 
     # __getitem__, top, sample inherited from CountingProbDist
@@ -50,16 +70,15 @@ class NgramWordModel(CountingProbDist):
 
     def add_cond_prob(self, ngram):
         """Build the conditional probabilities P(wn | (w1, ..., wn-1)"""
-        if ngram[:-1] not in self.cond_prob:
-            self.cond_prob[ngram[:-1]] = CountingProbDist()
-        self.cond_prob[ngram[:-1]].add(ngram[-1])
+        prefix = ngram[:-1]
+        cond_prob = self.cond_prob.get(prefix)
+        if cond_prob is None:
+            cond_prob = self.cond_prob[prefix] = CountingProbDist()
+        cond_prob.add(ngram[-1])
 
     def add_sequence(self, words):
         """Add each tuple words[i:i+n], using a sliding window."""
-        n = self.n
-
-        for i in range(len(words) - n + 1):
-            t = tuple(words[i:i + n])
+        for t in zip(*(words[k:] for k in range(self.n))):
             self.add(t)
             self.add_cond_prob(t)
 
@@ -91,13 +110,15 @@ class UnigramCharModel(NgramCharModel):
     def __init__(self, observation_sequence=None, default=0):
         CountingProbDist.__init__(self, default=default)
         self.n = 1
-        self.cond_prob = defaultdict()
+        self.cond_prob = {}
         self.add_sequence(observation_sequence or [])
 
     def add_sequence(self, words):
+        counts = Counter()
         for word in words:
-            for char in word:
-                self.add(char)
+            counts.update(word)
+        for char, count in counts.items():
+            self.add(char, count)
 
 # ______________________________________________________________________________
 
@@ -105,27 +126,45 @@ class UnigramCharModel(NgramCharModel):
 def viterbi_segment(text, P):
     """Find the best segmentation of the string of characters, given the
     UnigramWordModel P."""
-    # best[i] = best probability for text[0:i]
-    # words[i] = best word ending at position i
+    # best[i] = best log probability for text[0:i]
+    # back_len[i] = length of the best word ending at position i
     n = len(text)
-    words = [''] + list(text)
-    best = [1.0] + [0.0] * n
+    back_len = [1] * (n + 1)
+    best = [0.0] + [-inf] * n
+    # Work with logs so long texts do not underflow, and walk the trie of
+    # P's words from each start j instead of slicing out every text[j:i].
+    trie = P.build_trie()
+    log_total = log(P.n_obs)
+    unseen = log(P.default) - log_total if P.default else -inf
     # Fill in the vectors best words via dynamic programming
-    for i in range(n+1):
-        for j in range(0, i):
-            w = text[j:i]
-            curr_score = P[w] * best[i - len(w)]
+    for j in range(n):
+        if best[j] == -inf:
+            continue
+        node = trie
+        for i in range(j + 1, n + 1):
+            if node is not None:
+                node = node.get(text[i - 1])
+            if node is not None and None in node:
+                logp = log(node[None]) - log_total
+            elif node is None and unseen == -inf:
+                break
+            else:
+                logp = unseen
+            if logp == -inf:
+                continue
+            curr_score = logp + best[j]
             if curr_score >= best[i]:
                 best[i] = curr_score
-                words[i] = w
-    # Now recover the sequence of best words
+                back_len[i] = i - j
+    # Now recover the sequence of best words, from the end backwards
     sequence = []
-    i = len(words) - 1
+    i = n
     while i > 0:
-        sequence[0:0] = [words[i]]
-        i = i - len(words[i])
+        sequence.append(text[i - back_len[i]:i])
+        i = i - back_len[i]
+    sequence.reverse()
     # Return sequence of best words and overall probability
-    return sequence, best[-1]
+    return sequence, exp(best[-1])
 
 
 # ______________________________________________________________________________
@@ -146,9 +185,13 @@ class IRSystem:
         """Create an IR System. Optionally specify stopwords."""
         # index is a map of {word: {docid: count}}, where docid is an int,
         # indicating the index into the documents list.
-        self.index = defaultdict(lambda: defaultdict(int))
+        self.index = {}
         self.stopwords = set(words(stopwords))
         self.documents = []
+        # postings and doc_log_nwords are built from index and documents
+        # by finalize() when a query needs them
+        self.postings = None
+        self.doc_log_nwords = None
 
     def index_collection(self, filenames):
         """Index a whole collection of files."""
@@ -164,9 +207,23 @@ class IRSystem:
         docwords = words(text)
         docid = len(self.documents)
         self.documents.append(Document(title, url, len(docwords)))
-        for word in docwords:
-            if word not in self.stopwords:
-                self.index[word][docid] += 1
+        counts = Counter(docwords)
+        for word in self.stopwords:
+            counts.pop(word, None)
+        for word, count in counts.items():
+            self.index.setdefault(word, {})[docid] = count
+        self.postings = None
+
+    def finalize(self):
+        """Build the postings, a map of {word: (docids, counts)} holding
+        the index as sorted NumPy arrays, so queries can score all the
+        documents for a word at once. Adding a document discards them."""
+        self.postings = {}
+        for word, doccounts in self.index.items():
+            docids, counts = zip(*sorted(doccounts.items()))
+            self.postings[word] = (np.array(docids, dtype=np.int32),
+                                   np.array(counts, dtype=np.int32))
+        self.doc_log_nwords = np.log(1 + np.array([doc.nwords for doc in self.documents]))
 
     def query(self, query_text, n=10):
         """Return a list of n (score, docid) pairs for the best matches.
@@ -176,21 +233,48 @@ class IRSystem:
             self.index_document(doctext, query_text)
             return []
 
+        if self.postings is None:
+            self.finalize()
         qwords = [w for w in words(query_text) if w not in self.stopwords]
-        shortest = argmin(qwords, key=lambda w: len(self.index[w]))
-        docids = self.index[shortest]
-        return heapq.nlargest(n, ((self.total_score(qwords, docid), docid) for docid in docids))
+        shortest = argmin(qwords, key=lambda w: len(self.index.get(w, ())))
+        if shortest not in self.postings:
+            return []
+        docids = self.postings[shortest][0]
+        scores = self.total_scores(qwords, docids)
+        # Select the top n in linear time, keeping every score tied with the
+        # n-th so that ties still go to the larger docid, as with nlargest
+        top = np.arange(len(scores))
+        if 0 < n < len(scores):
+            kth = len(scores) - n
+            threshold = scores[np.argpartition(scores, kth)[kth]]
+            top = np.flatnonzero(scores >= threshold)
+        top = top[np.lexsort((-docids[top], -scores[top]))][:max(n, 0)]
+        return list(zip(scores[top].tolist(), docids[top].tolist()))
 
     def score(self, word, docid):
         """Compute a score for this word on the document with this docid."""
         # There are many options; here we take a very simple approach
-        return (log(1 + self.index[word][docid]) /
+        return (log(1 + self.index.get(word, {}).get(docid, 0)) /
                 log(1 + self.documents[docid].nwords))
 
     def total_score(self, words, docid):
         """Compute the sum of the scores of these words on the document with this docid."""
         return sum(self.score(word, docid) for word in words)
 
+    def total_scores(self, words, docids):
+        """Compute total_score(words, docid) for every docid in the sorted
+        array docids, using the postings built by finalize()."""
+        scores = np.zeros(len(docids))
+        for word in words:
+            if word not in self.postings:
+                continue
+            word_docids, word_counts = self.postings[word]
+            # Find each docid in the word's postings; missing ones count 0
+            pos = np.minimum(np.searchsorted(word_docids, docids), len(word_docids) - 1)
+            counts = np.where(word_docids[pos] == docids, word_counts[pos], 0)
+            scores += np.log(1 + counts) / self.doc_log_nwords[docids]
+        return scores
+
     def present(self, results):
         """Present the results as a list."""
         for (score, docid) in results:
@@ -279,10 +363,7 @@ def rot13(plaintext):
 
 def translate(plaintext, function):
     """Translate chars of a plaintext with the given function."""
-    result = ""
-    for char in plaintext:
-        result += function(char)
-    return result
+    return ''.join(map(function, plaintext))
 
 
 def maketrans(from_, to_):
@@ -296,9 +377,8 @@ def maketrans(from_, to_):
 
 def encode(plaintext, code):
     """Encode text using a code which is a permutation of the alphabet."""
-    trans = maketrans(alphabet + alphabet.upper(), code + code.upper())
-
-    return translate(plaintext, trans)
+    return plaintext.translate(str.maketrans(alphabet + alphabet.upper(),
+                                             code + code.upper()))
 
 
 def bigrams(text):
@@ -310,6 +390,23 @@ def bigrams(text):
     """
     return [text[i:i + 2] for i in range(len(text) - 1)]
 
+
+# char_indices numbers these chars in order, and gives any other char
+# the next index, len(indexed_chars)
+indexed_chars = alphabet + ' ' + '0123456789'
+char_index_table = np.full(128, len(indexed_chars))
+char_index_table[[ord(c) for c in indexed_chars]] = np.arange(len(indexed_chars))
+
+
+def char_indices(text):
+    """Return an array mapping each char of text to 0-25 for the letters
+    a-z, 26 for a space, 27-36 for the digits 0-9 and 37 for anything else.
+    >>> char_indices('ab z!9')
+    array([ 0,  1, 26, 25, 37, 36])
+    """
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+    return np.where(codes < 128, char_index_table[np.minimum(codes, 127)], len(indexed_chars))
+
 # Decoding a Shift (or Caesar) Cipher
 
 
@@ -321,21 +418,34 @@ class ShiftDecoder:
 
     def __init__(self, training_text):
         training_text = canonicalize(training_text)
-        self.P2 = CountingProbDist(bigrams(training_text), default=1)
+        # count the letter pairs as they are sliced, without a list of them
+        self.P2 = CountingProbDist((training_text[i:i + 2] for i in range(len(training_text) - 1)),
+                                   default=1)
+        # log_P2[i, j] = log P2 of the letter pair with char_indices i, j;
+        # pairs with a char outside indexed_chars keep the unseen probability
+        other = len(indexed_chars)
+        self.log_P2 = np.full((other + 1, other + 1), log(self.P2.default / self.P2.n_obs))
+        for bi, count in self.P2.dictionary.items():
+            i, j = char_indices(bi)
+            if i != other and j != other:
+                self.log_P2[i, j] = log(count / self.P2.n_obs)
 
     def score(self, plaintext):
-        """Return a score for text based on how common letters pairs are."""
-
-        s = 1.0
-        for bi in bigrams(plaintext):
-            s = s * self.P2[bi]
-
-        return s
+        """Return a log score for text based on how common letters pairs are."""
+        idx = char_indices(plaintext)
+        return self.log_P2[idx[:-1], idx[1:]].sum()
 
     def decode(self, ciphertext):
         """Return the shift decoding of text with the best score."""
+        # Shift the letter indices instead of re-encoding the text 26 times
+        idx = char_indices(ciphertext)
+        letters = idx < len(alphabet)
+
+        def shift_score(n):
+            shifted = np.where(letters, (idx + n) % len(alphabet), idx)
+            return self.log_P2[shifted[:-1], shifted[1:]].sum()
 
-        return argmax(all_shifts(ciphertext), key=lambda shift: self.score(shift))
+        return shift_encode(ciphertext, argmax(range(len(alphabet)), key=shift_score))
 
 
 def all_shifts(text):
@@ -365,34 +475,47 @@ class PermutationDecoder:
         self.Pwords = UnigramWordModel(words(training_text))
         self.P1 = UnigramWordModel(training_text)  # By letter
         self.P2 = NgramWordModel(2, words(training_text))  # By letter pair
+        # log_P1[i] and log_P2[i, j] hold the log terms of score for the
+        # chars with char_indices i and j, with the same small additions
+        self.log_P1 = np.full(len(indexed_chars) + 1, log(1e-5))
+        self.log_P2 = np.full((len(indexed_chars) + 1,) * 2, log(1e-10))
+        for i, a in enumerate(indexed_chars):
+            self.log_P1[i] = log(self.P1.dictionary.get(a, 0) / self.P1.n_obs + 1e-5)
+            for j, b in enumerate(indexed_chars):
+                self.log_P2[i, j] = log(self.P2.dictionary.get(a + b, 0) / self.P2.n_obs + 1e-10)
+        # log_Pwords[w] is the word term of score; unseen words get log(1e-20)
+        self.log_Pwords = {w: log(count / self.Pwords.n_obs + 1e-20)
+                           for w, count in self.Pwords.dictionary.items()}
 
     def decode(self, ciphertext):
         """Search for a decoding of the ciphertext."""
         self.ciphertext = canonicalize(ciphertext)
         # reduce domain to speed up search
         self.chardomain = {c for c in self.ciphertext if c != ' '}
+        # score translates each distinct word once and weighs it by its count
+        self.cipherwords = Counter(self.ciphertext.split())
         problem = PermutationDecoderProblem(decoder=self)
         solution = search.best_first_graph_search(
             problem, lambda node: self.score(node.state))
 
         solution.state[' '] = ' '
-        return translate(self.ciphertext, lambda c: solution.state[c])
+        return self.ciphertext.translate(str.maketrans(dict(solution.state)))
 
     def score(self, code):
         """Score is product of word scores, unigram scores, and bigram scores.
         This can get very small, so we use logs and exp."""
 
-        # remake code dictionary to contain translation for all characters
-        full_code = code.copy()
-        full_code.update({x: x for x in self.chardomain if x not in code})
-        full_code[' '] = ' '
-        text = translate(self.ciphertext, lambda c: full_code[c])
+        # chars the code does not cover yet are left as they are by translate
+        table = str.maketrans(dict(code))
+        idx = char_indices(self.ciphertext.translate(table))
+        unseen = log(1e-20)
 
         # add small positive value to prevent computing log(0)
         # TODO: Modify the values to make score more accurate
-        logP = (sum(log(self.Pwords[word] + 1e-20) for word in words(text)) +
-                sum(log(self.P1[c] + 1e-5) for c in text) +
-                sum(log(self.P2[b] + 1e-10) for b in bigrams(text)))
+        logP = (sum(count * self.log_Pwords.get(word.translate(table), unseen)
+                    for word, count in self.cipherwords.items()) +
+                self.log_P1[idx].sum() +
+                self.log_P2[idx[:-1], idx[1:]].sum())
         return -exp(logP)
 
 